@@ -1,2 +1,3 @@
 from .async_query import export_question_bulk_filter_values
+from .spill_buffer import SpillBuffer
 from .sync_query import export_question
\ No newline at end of file
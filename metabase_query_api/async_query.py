@@ -1,5 +1,8 @@
 import asyncio
 import copy
+import functools
+import json
+import weakref
 from urllib import parse
 
 import aiohttp
@@ -8,15 +11,69 @@ from tenacity import *
 
 from .async_card import async_card_query
 from .async_dataset import async_dataset
+from .spill_buffer import SpillBuffer
 from .sync_card import parse_card_question
 from .sync_dataset import parse_dataset_question
 
 nest_asyncio.apply()  # To avoid asyncio error
 
+# Requests that are being sent per event loop, shared by every caller asking for the same payload
+in_flight_requests = weakref.WeakKeyDictionary()
 
-async def export_question_bulk_filter_values(url: str, session: str, bulk_filter_slug: str, bulk_values_list: list, chunk_size=2000, retry_attempts=10, verbose=True, timeout=1800, custom_retry_errors=[]):
+
+def request_key(session: str, domain_url: str, api_endpoint: str, payload, question_id=None, retry_attempts=None, timeout=None, custom_retry_errors=[]):
+    '''
+    This function builds a key to identify identical requests, it is the exact card parameters or dataset query and the request settings.
+
+    :param session: Metabase Session
+    :param domain_url: https://your-domain.com
+    :param api_endpoint: card or dataset
+    :param payload: Card parameters or dataset query
+    :param question_id: 123456, only for card
+    :param retry_attempts: Number of retry attempts
+    :param timeout: Timeout for each request
+    :param custom_retry_errors: A list of string errors to retry
+    :return: A hashable key
+    '''
+    return (session, domain_url, api_endpoint, question_id, retry_attempts, timeout, tuple(custom_retry_errors), json.dumps(payload, sort_keys=True, default=str))
+
+
+async def coalesce_request(key, get_data, verbose=True, print_suffix=None):
+    '''
+    This function sends a request only if an identical request is not in flight, otherwise it waits for the result of that request.
+    Concurrent callers and duplicate chunks in a bulk job will share one HTTP call and one decoded result, so do not modify the result.
+    Only callers in the same event loop are coalesced. The request runs on the client session of the first caller, which must stay open until the request is done.
+
+    :param key: Key built by request_key
+    :param get_data: Async function without arguments to get data
+    :param verbose: Print the progress
+    :param print_suffix: String
+    :return: Result of get_data
+    '''
+    loop_requests = in_flight_requests.setdefault(asyncio.get_running_loop(), {})
+    task = loop_requests.get(key)
+    if task is None:
+        task = asyncio.ensure_future(get_data())
+        loop_requests[key] = task
+
+        def remove_request(done_task):
+            if loop_requests.get(key) is done_task:
+                del loop_requests[key]
+
+        task.add_done_callback(remove_request)
+    elif verbose:
+        print('Joining an identical request in flight', print_suffix)
+
+    # Shield the shared request, so cancelling a caller does not cancel it for the others
+    return await asyncio.shield(task)
+
+
+async def export_question_bulk_filter_values(url: str, session: str, bulk_filter_slug: str, bulk_values_list: list, chunk_size=2000, retry_attempts=10, verbose=True, timeout=1800, custom_retry_errors=[], client_session=None, raise_errors=False, max_memory_rows=None, max_memory_bytes=None, executor=None):
     '''
     This function will split bulk_values_list into multiple small values lists, and then send multiple requests to get data, limiting 5 connectors per host.
+    Identical requests in flight, from concurrent calls in the same event loop or duplicate chunks, are sent only once and share the result.
+    Concurrent calls with the same URL, session and bulk_filter_slug also parse the question only once.
+    A shared request runs on the client session of the call that sent it first.
 
     To call this function, you need to import asyncio, and then call it by syntax: asyncio.run(export_question_bulk_filter_values()).
 
@@ -29,7 +86,12 @@ async def export_question_bulk_filter_values(url: str, session: str, bulk_filter
     :param verbose: Print the progress
     :param timeout: Timeout for each request
     :param custom_retry_errors: A list of string errors that you want to retry. Default are some PrestoDB errors.
-    :return: JSON data
+    :param client_session: aiohttp.ClientSession to share a connection pool with other calls, it will not be closed. Default creates a new one.
+    :param raise_errors: Raise an error if there were error parts instead of returning the successful data
+    :param max_memory_rows: Maximum number of received records kept in memory, above it records are spilled to a temporary file. Parts still in flight are not counted, and new requests only pause while a spill write is running
+    :param max_memory_bytes: Maximum size of records kept in memory, measured as JSON, works like max_memory_rows
+    :param executor: concurrent.futures.Executor to parse the question and spill records without blocking the event loop. Default is the event loop default executor.
+    :return: JSON data, or a SpillBuffer to iterate over records in completion order of parts if a memory budget is set
     '''
 
     if chunk_size > 2000 or chunk_size < 1:
@@ -44,12 +106,24 @@ async def export_question_bulk_filter_values(url: str, session: str, bulk_filter
     # Split bulk values list to chunks
     bulk_values_lists = [bulk_values_list[i:i + chunk_size] for i in range(0, len(bulk_values_list), chunk_size)]
 
-    # Client session for requesting
-    client_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=5))
+    # Buffer to keep records within the memory budget
+    buffer = SpillBuffer(max_memory_rows=max_memory_rows, max_memory_bytes=max_memory_bytes, executor=executor) if max_memory_rows is not None or max_memory_bytes is not None else None
+
+    # Client session for requesting, only close the session created here
+    close_client_session = client_session is None
+    if close_client_session:
+        client_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=5))
+
+    # Parse question to get necessary variables and payload, identical calls in flight parse it only once
+    parse_question = parse_card_question if api_endpoint == 'card' else parse_dataset_question
+
+    async def get_question_data():
+        return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(parse_question, url=url, session=session, bulk_filter_slug=bulk_filter_slug, verbose=verbose))
+
+    question_data = await coalesce_request(key=('parse', session, url, bulk_filter_slug), get_data=get_question_data, verbose=verbose, print_suffix='(parsing question)')
 
-    # Parse question to get necessary variables and payload
     if api_endpoint == 'card':
-        card_data = parse_card_question(url=url, session=session, bulk_filter_slug=bulk_filter_slug, verbose=verbose)
+        card_data = question_data
         domain_url = card_data['domain_url']
         question_id = card_data['question_id']
         parameters = card_data['parameters']
@@ -72,7 +146,7 @@ async def export_question_bulk_filter_values(url: str, session: str, bulk_filter
 
 
     elif api_endpoint == 'dataset':
-        table_data = parse_dataset_question(url=url, session=session, bulk_filter_slug=bulk_filter_slug, verbose=verbose)
+        table_data = question_data
         domain_url = table_data['domain_url']
         dataset_query = table_data['dataset_query']
         column_sort_order = table_data['column_sort_order']
@@ -109,20 +183,29 @@ async def export_question_bulk_filter_values(url: str, session: str, bulk_filter
                                            timeout=timeout,
                                            custom_retry_errors=custom_retry_errors)
 
-        # Get data
-        query_records = await get_query_data()
+        # Get data, identical requests in flight are sent only once
+        key = request_key(session=session, domain_url=domain_url, api_endpoint=api_endpoint, payload=payload, question_id=question_id if api_endpoint == 'card' else None,
+                          retry_attempts=retry_attempts, timeout=timeout, custom_retry_errors=custom_retry_errors)
+        query_records = await coalesce_request(key=key, get_data=get_query_data, verbose=verbose, print_suffix=print_suffix)
 
         # Raise error by user
         if 'error' in query_records:
             raise Exception(query_records['error'])
 
-        # Sort columns
+        # Sort columns, always rebuild records so that callers sharing a request do not share the same dicts
         if column_sort_order:
             query_records = [{col: item[col] for col in column_sort_order if col in item} for item in query_records]
+        else:
+            query_records = [dict(item) for item in query_records]
 
         if verbose:
             print('Received data', print_suffix)
 
+        # Store records in the buffer instead of keeping them until all parts are done
+        if buffer is not None:
+            await buffer.put(query_records)
+            return []
+
         return query_records
 
     # Create multiple async tasks
@@ -133,6 +216,8 @@ async def export_question_bulk_filter_values(url: str, session: str, bulk_filter
         counter = 0
         for modified_parameters in modified_parameters_list:
             counter += 1
+            if buffer is not None:
+                await buffer.wait_for_room()
             tasks.append(asyncio.create_task(query_quest(payload=modified_parameters, print_suffix=f'({counter}/{total})', verbose=verbose)))
             await asyncio.sleep(1)
     elif api_endpoint == 'dataset':
@@ -140,23 +225,33 @@ async def export_question_bulk_filter_values(url: str, session: str, bulk_filter
         counter = 0
         for modified_dataset_query in modified_dataset_query_list:
             counter += 1
+            if buffer is not None:
+                await buffer.wait_for_room()
             tasks.append(asyncio.create_task(query_quest(payload=modified_dataset_query, print_suffix=f'({counter}/{total})', verbose=verbose)))
             await asyncio.sleep(1)
 
     # Combine tasks results
     res = await asyncio.gather(*tasks, return_exceptions=True) # return_exceptions to handle error and send user successful data
-    await client_session.close()
+    if close_client_session:
+        await client_session.close()
 
     success_results = []
-    has_error = False
+    error_count = 0
     for idx, result in enumerate(res):
         idx += 1
         if isinstance(result, Exception):
             print(f"Task ({idx}/{total}) error: {result}")
-            has_error = True
+            error_count += 1
         else:
             success_results.append(result)
-    if has_error:
+    if error_count and raise_errors:
+        if buffer is not None:
+            buffer.close()
+        raise Exception(f'There were {error_count}/{total} error parts.')
+    if error_count:
         print('There were error parts. You will receive the successfully retrieved data. Please filter out the parts that have not been retrieved so that you can run them again.')
 
+    if buffer is not None:
+        return buffer
+
     return sum(success_results, [])
\ No newline at end of file
@@ -0,0 +1,254 @@
+import argparse
+import asyncio
+import csv
+import functools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import aiohttp
+
+from .async_query import export_question_bulk_filter_values
+from .spill_buffer import SpillBuffer
+from .sync_query import export_question
+
+
+def load_manifest(path: str):
+    '''
+    This function reads a JSON or YAML manifest of questions.
+    The manifest is a list of jobs, or a dict with a jobs list and optional session and defaults for every job.
+
+    :param path: manifest.json, manifest.yaml or manifest.yml
+    :return: Manifest as a dict with session, defaults and jobs
+    '''
+    text = Path(path).read_text()
+
+    if Path(path).suffix.lower() in ['.yaml', '.yml']:
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError('Please install PyYAML to read YAML manifests: pip install metabase-query-api[yaml]')
+        manifest = yaml.safe_load(text)
+    else:
+        manifest = json.loads(text)
+
+    if isinstance(manifest, list):
+        manifest = {'jobs': manifest}
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('jobs'), list):
+        raise ValueError('Manifest must be a list of jobs or have a jobs list')
+
+    base_dir = Path(path).parent
+    defaults = manifest.get('defaults') or {}
+    if not isinstance(defaults, dict):
+        raise ValueError('Manifest defaults must be a mapping')
+    jobs = []
+    for idx, job in enumerate(manifest['jobs']):
+        if not isinstance(job, dict):
+            raise ValueError(f'Job {idx + 1} must be a mapping')
+        job = {**defaults, **job}
+        for key in ['url', 'output']:
+            if key not in job:
+                raise ValueError(f'Job {idx + 1} has no {key}')
+        job.setdefault('name', Path(job['output']).stem)
+        job.setdefault('format', 'json')
+        if job['format'] not in ['json', 'xlsx', 'csv']:
+            raise ValueError(f'Job {job["name"]}: accepted values for format are json, xlsx, csv')
+        if 'bulk_filter_slug' in job:
+            if 'values_file' not in job:
+                raise ValueError(f'Job {job["name"]} has bulk_filter_slug but no values_file')
+            if job['format'] == 'xlsx':
+                raise ValueError(f'Job {job["name"]}: bulk jobs support json and csv formats')
+            job['values_file'] = str(base_dir / job['values_file'])
+        job['output'] = str(base_dir / job['output'])
+        jobs.append(job)
+
+    return {'session': manifest.get('session'), 'jobs': jobs}
+
+
+def load_values(path: str):
+    '''
+    This function reads bulk values from a JSON list file or a text file with one value per line.
+
+    :param path: values.json or values.txt
+    :return: A list of values
+    '''
+    text = Path(path).read_text()
+    if Path(path).suffix.lower() == '.json':
+        return json.loads(text)
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+def write_output(path: str, data, data_format: str):
+    '''
+    This function writes job data to the output path, creating parent folders.
+
+    :param path: Output path
+    :param data: JSON data, SpillBuffer or Bytes data
+    :param data_format: json, csv, xlsx
+    :return: Number of rows, None for Bytes data, and number of bytes written
+    '''
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+    if isinstance(data, bytes):
+        Path(path).write_bytes(data)
+        return None, len(data)
+
+    # Write records one by one, so a SpillBuffer is not loaded into memory
+    if data_format == 'csv':
+        # Keep the column order of the first record, then add new columns as they appear
+        columns = list(dict.fromkeys(col for record in data for col in record))
+        with open(path, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(data)
+    else:
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write('[')
+            for idx, record in enumerate(data):
+                if idx:
+                    file.write(', ')
+                json.dump(record, file, ensure_ascii=False)
+            file.write(']')
+
+    return len(data), Path(path).stat().st_size
+
+
+async def run_job(job: dict, session: str, semaphore: asyncio.Semaphore, executor: ThreadPoolExecutor, client_session: aiohttp.ClientSession, verbose=False):
+    '''
+    This function runs a job when the semaphore allows it, bulk jobs share the client session and others run in the executor.
+
+    :param job: Job in the manifest
+    :param session: Metabase Session
+    :param semaphore: Limit of running jobs
+    :param executor: Thread pool for export_question, parsing questions and reading and writing files
+    :param client_session: aiohttp.ClientSession shared by bulk jobs
+    :param verbose: Print the progress of each job
+    :return: Job result as a dict with name, ok, seconds, rows, bytes and error
+    '''
+    loop = asyncio.get_running_loop()
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            # Blocking work runs in the executor, so it does not stall requests of other jobs
+            if 'bulk_filter_slug' in job:
+                bulk_values_list = await loop.run_in_executor(executor, load_values, job['values_file'])
+                data = await export_question_bulk_filter_values(url=job['url'],
+                                                                session=session,
+                                                                bulk_filter_slug=job['bulk_filter_slug'],
+                                                                bulk_values_list=bulk_values_list,
+                                                                chunk_size=job.get('chunk_size', 2000),
+                                                                retry_attempts=job.get('retry_attempts', 10),
+                                                                verbose=verbose,
+                                                                timeout=job.get('timeout', 1800),
+                                                                custom_retry_errors=job.get('custom_retry_errors', []),
+                                                                client_session=client_session,
+                                                                raise_errors=True,
+                                                                max_memory_rows=job.get('max_memory_rows'),
+                                                                max_memory_bytes=job.get('max_memory_bytes'),
+                                                                executor=executor)
+            else:
+                data = await loop.run_in_executor(executor, functools.partial(export_question,
+                                                                              url=job['url'],
+                                                                              session=session,
+                                                                              data_format=job['format'],
+                                                                              retry_attempts=job.get('retry_attempts', 0),
+                                                                              verbose=verbose,
+                                                                              timeout=job.get('timeout', 1800),
+                                                                              custom_retry_errors=job.get('custom_retry_errors', [])))
+            rows, size = await loop.run_in_executor(executor, functools.partial(write_output, path=job['output'], data=data, data_format=job['format']))
+            if isinstance(data, SpillBuffer):
+                data.close()
+            return {'name': job['name'], 'ok': True, 'seconds': time.perf_counter() - start, 'rows': rows, 'bytes': size, 'error': None}
+        except Exception as e:
+            return {'name': job['name'], 'ok': False, 'seconds': time.perf_counter() - start, 'rows': None, 'bytes': None, 'error': str(e) or type(e).__name__}
+
+
+async def run_jobs(jobs: list, session: str, max_jobs=4, max_connections=10, max_connections_per_host=5, verbose=False):
+    '''
+    This function runs all jobs on a shared thread pool and aiohttp connection pool, printing the progress.
+
+    :param jobs: Jobs in the manifest
+    :param session: Metabase Session
+    :param max_jobs: Maximum number of jobs running at once
+    :param max_connections: Maximum number of connections of bulk jobs
+    :param max_connections_per_host: Maximum number of connections per host of bulk jobs
+    :param verbose: Print the progress of each job
+    :return: A list of job results in manifest order, and the elapsed seconds of all jobs
+    '''
+    start = time.perf_counter()
+    semaphore = asyncio.Semaphore(max_jobs)
+    connector = aiohttp.TCPConnector(limit=max_connections, limit_per_host=max_connections_per_host)
+
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        async with aiohttp.ClientSession(connector=connector) as client_session:
+            tasks = [asyncio.create_task(run_job(job=job, session=session, semaphore=semaphore, executor=executor, client_session=client_session, verbose=verbose)) for job in jobs]
+
+            total = len(tasks)
+            counter = 0
+            for task in asyncio.as_completed(tasks):
+                result = await task
+                counter += 1
+                status = 'done' if result['ok'] else f'failed: {result["error"]}'
+                print(f'({counter}/{total}) {result["name"]} {status} in {result["seconds"]:.1f}s')
+
+    return [task.result() for task in tasks], time.perf_counter() - start
+
+
+def print_summary(results: list, seconds: float):
+    '''
+    This function prints a timing summary of all jobs.
+
+    :param results: Job results
+    :param seconds: Elapsed seconds of all jobs, jobs run in parallel so it is not the sum of job seconds
+    :return: None
+    '''
+    name_width = max([len(r['name']) for r in results] + [3])
+    print()
+    print(f'{"Job":<{name_width}}  {"Status":<6}  {"Seconds":>8}  {"Rows":>10}  {"Bytes":>12}')
+    for r in results:
+        rows = '' if r['rows'] is None else r['rows']
+        size = '' if r['bytes'] is None else r['bytes']
+        print(f'{r["name"]:<{name_width}}  {"ok" if r["ok"] else "failed":<6}  {r["seconds"]:>8.1f}  {rows:>10}  {size:>12}')
+    failed = sum(not r['ok'] for r in results)
+    print(f'{len(results) - failed} succeeded, {failed} failed, {seconds:.1f}s elapsed')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='metabase-query', description='Export Metabase questions listed in a JSON or YAML manifest.')
+    parser.add_argument('manifest', help='Path to a JSON or YAML manifest')
+    parser.add_argument('--session', help='Metabase Session, defaults to the manifest session, then the METABASE_SESSION environment variable')
+    parser.add_argument('--jobs', type=int, default=4, help='Maximum number of jobs running at once (default: 4)')
+    parser.add_argument('--connections', type=int, default=10, help='Maximum number of connections of bulk jobs (default: 10)')
+    parser.add_argument('--connections-per-host', type=int, default=5, help='Maximum number of connections per host of bulk jobs (default: 5)')
+    parser.add_argument('--verbose', action='store_true', help='Print the progress of each request')
+    args = parser.parse_args(argv)
+
+    if args.jobs < 1 or args.connections < 1 or args.connections_per_host < 1:
+        parser.error('--jobs, --connections and --connections-per-host must be positive')
+
+    try:
+        manifest = load_manifest(args.manifest)
+    except (OSError, ValueError, ImportError) as e:
+        parser.error(str(e))
+
+    # Precedence: --session, the manifest session, then METABASE_SESSION
+    session = args.session or manifest['session'] or os.environ.get('METABASE_SESSION')
+    if not session:
+        parser.error('Please input a Metabase Session by --session, METABASE_SESSION or the manifest')
+
+    results, seconds = asyncio.run(run_jobs(jobs=manifest['jobs'],
+                                            session=session,
+                                            max_jobs=args.jobs,
+                                            max_connections=args.connections,
+                                            max_connections_per_host=args.connections_per_host,
+                                            verbose=args.verbose))
+    print_summary(results=results, seconds=seconds)
+
+    return 1 if any(not r['ok'] for r in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+import weakref
+
+
+class SpillBuffer:
+    '''
+    This class collects records of a bulk query within a memory budget.
+    Above the budget, records are spilled to a temporary compressed JSON lines file, which is removed by close() or when the buffer is garbage collected.
+    Iterate over it to get the records, spilled records come first, then the records still in memory.
+    '''
+
+    def __init__(self, max_memory_rows=None, max_memory_bytes=None, executor=None):
+        '''
+        :param max_memory_rows: Maximum number of records kept in memory
+        :param max_memory_bytes: Maximum size of records kept in memory, measured as JSON
+        :param executor: concurrent.futures.Executor to write spilled records. Default is the event loop default executor.
+        '''
+        if max_memory_rows is not None and max_memory_rows < 1:
+            raise ValueError('max_memory_rows must be positive')
+        if max_memory_bytes is not None and max_memory_bytes < 1:
+            raise ValueError('max_memory_bytes must be positive')
+
+        self.max_memory_rows = max_memory_rows
+        self.max_memory_bytes = max_memory_bytes
+        self.executor = executor
+
+        # Records waiting to be stored and records stored in memory, as JSON lines
+        self.memory_rows = 0
+        self.memory_bytes = 0
+        self.lines = []
+
+        self.spilled_rows = 0
+        self.path = None
+        self.file = None
+        self.finalizer = None
+        self.condition = asyncio.Condition()
+
+    def __len__(self):
+        return self.spilled_rows + len(self.lines)
+
+    def __iter__(self):
+        # A compressed file can only be read after closing, the next spill appends a new gzip member
+        self.close_file()
+        if self.path:
+            with gzip.open(self.path, 'rb') as file:
+                for line in file:
+                    yield json.loads(line)
+        for line in self.lines:
+            yield json.loads(line)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def over_budget(self):
+        return (self.max_memory_rows is not None and self.memory_rows > self.max_memory_rows) or \
+               (self.max_memory_bytes is not None and self.memory_bytes > self.max_memory_bytes)
+
+    async def put(self, records: list):
+        '''
+        This function stores records, and spills all records in memory to disk if the budget is exceeded.
+
+        :param records: JSON data
+        :return: None
+        '''
+        lines = [json.dumps(record, ensure_ascii=False, default=str).encode() + b'\n' for record in records]
+        size = sum(len(line) for line in lines)
+        self.memory_rows += len(lines)
+        self.memory_bytes += size
+
+        async with self.condition:
+            self.lines.extend(lines)
+            if self.over_budget():
+                lines, self.lines = self.lines, []
+                await asyncio.get_running_loop().run_in_executor(self.executor, self.write, lines)
+                self.memory_rows -= len(lines)
+                self.memory_bytes -= sum(len(line) for line in lines)
+                self.condition.notify_all()
+
+    async def wait_for_room(self):
+        '''
+        This function waits until the records in memory are within the budget.
+        put() always spills back within the budget, so it only waits while a spill write is running, records not yet put are not counted.
+
+        :return: None
+        '''
+        async with self.condition:
+            await self.condition.wait_for(lambda: not self.over_budget())
+
+    def write(self, lines: list):
+        if self.path is None:
+            fd, self.path = tempfile.mkstemp(prefix='metabase-query-', suffix='.jsonl.gz')
+            os.close(fd)
+            self.finalizer = weakref.finalize(self, SpillBuffer.remove, self.path)
+        if self.file is None:
+            self.file = gzip.open(self.path, 'ab', compresslevel=1)
+        self.file.writelines(lines)
+        self.spilled_rows += len(lines)
+
+    def close_file(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        '''
+        This function removes the spilled records and the records in memory.
+
+        :return: None
+        '''
+        self.close_file()
+        if self.finalizer:
+            self.finalizer()
+        self.path = None
+        self.finalizer = None
+        self.lines = []
+        self.memory_rows = 0
+        self.memory_bytes = 0
+        self.spilled_rows = 0
+
+    @staticmethod
+    def remove(path):
+        if os.path.exists(path):
+            os.remove(path)
@@ -5,7 +5,7 @@ README = (Path(__file__).parent / "README.md").read_text()
 
 setup(
     name='metabase-query-api',
-    version='1.1.3',
+    version='1.1.4',
     description='Metabase Query API with Retry and Bulk Param Values',
     long_description=README,
     long_description_content_type="text/markdown",
@@ -15,7 +15,16 @@ setup(
     packages=find_packages(),
     install_requires=[
         'requests',
+        'aiohttp',
         'tenacity',
         'nest-asyncio'
-    ]
+    ],
+    extras_require={
+        'yaml': ['pyyaml']
+    },
+    entry_points={
+        'console_scripts': [
+            'metabase-query=metabase_query_api.cli:main'
+        ]
+    }
 )
\ No newline at end of file
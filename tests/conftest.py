@@ -0,0 +1,63 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import parse
+
+import pytest
+
+CARD = {
+    'result_metadata': [{'display_name': 'ID'}, {'display_name': 'Name'}],
+    'parameters': [{'slug': 'id', 'type': 'category', 'target': ['dimension', ['template-tag', 'id']]}],
+    'dataset_query': {'native': {'template-tags': {}}},
+}
+
+
+@pytest.fixture
+def metabase():
+    '''
+    A fake Metabase server, the card query API answers slowly so that identical requests overlap.
+    Exporting card 2 returns a Metabase error.
+    '''
+    card = dict(CARD)
+    gets = []
+    posts = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, data):
+            body = json.dumps(data).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            gets.append(self.path)
+            time.sleep(0.5)
+            self.send_json(card)
+
+        def do_POST(self):
+            # Export API of export_question
+            path = parse.urlparse(self.path).path
+            if path.endswith('/query/json'):
+                if path.startswith('/api/card/2/'):
+                    return self.send_json({'error': 'Something went wrong'})
+                return self.send_json([{'Name': 'name 1', 'ID': '1'}])
+
+            # Card query API of export_question_bulk_filter_values
+            payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            posts.append(payload)
+            time.sleep(1.5)
+            values = payload['parameters'][0]['value']
+            self.send_json({'data': {'cols': [{'display_name': 'Name'}, {'display_name': 'ID'}],
+                                     'rows': [[f'name {v}', v] for v in values]}})
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield {'url': f'http://127.0.0.1:{server.server_port}/question/1-example', 'card': card, 'gets': gets, 'posts': posts}
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,106 @@
+import asyncio
+import threading
+
+from metabase_query_api import SpillBuffer, export_question_bulk_filter_values
+from metabase_query_api.async_query import coalesce_request
+
+
+def export(url, values):
+    return export_question_bulk_filter_values(url=url, session='session', bulk_filter_slug='id', bulk_values_list=values, chunk_size=2, retry_attempts=1, verbose=False)
+
+
+def test_concurrent_calls_send_one_request(metabase):
+    async def main():
+        return await asyncio.gather(export(metabase['url'], ['1', '2']), export(metabase['url'], ['1', '2']))
+
+    first, second = asyncio.run(main())
+
+    assert len(metabase['posts']) == 1
+    assert first == second == [{'ID': '1', 'Name': 'name 1'}, {'ID': '2', 'Name': 'name 2'}]
+
+
+def test_concurrent_calls_parse_question_once(metabase):
+    async def main():
+        return await asyncio.gather(*[export(metabase['url'], ['1', '2']) for _ in range(3)])
+
+    asyncio.run(main())
+
+    assert metabase['gets'] == ['/api/card/1']
+
+
+def test_duplicate_chunks_share_one_request(metabase):
+    records = asyncio.run(export(metabase['url'], ['1', '2', '1', '2']))
+
+    assert len(metabase['posts']) == 1
+    assert [r['ID'] for r in records] == ['1', '2', '1', '2']
+
+
+def test_callers_sharing_a_request_get_their_own_records(metabase):
+    # Without result_metadata, records are not rebuilt by sorting columns
+    metabase['card']['result_metadata'] = None
+
+    async def main():
+        return await asyncio.gather(*[export(metabase['url'], ['1', '2', '1', '2']) for _ in range(3)])
+
+    first, second, third = asyncio.run(main())
+    first[0]['ID'] = 'MUTATED'
+
+    assert len(metabase['posts']) == 1
+    assert second[0]['ID'] == third[0]['ID'] == first[2]['ID'] == '1'
+
+
+def test_memory_budget_returns_spill_buffer(metabase):
+    with asyncio.run(export_question_bulk_filter_values(url=metabase['url'], session='session', bulk_filter_slug='id', bulk_values_list=['1', '2', '3', '4', '5'],
+                                                        chunk_size=2, retry_attempts=1, verbose=False, max_memory_rows=1)) as records:
+        assert isinstance(records, SpillBuffer)
+        # The last part has 1 record, which is within the budget
+        assert records.spilled_rows == 4
+        assert len(records) == 5
+        assert sorted(records, key=lambda r: r['ID']) == [{'ID': i, 'Name': f'name {i}'} for i in ['1', '2', '3', '4', '5']]
+
+
+def test_cancelled_caller_does_not_cancel_shared_request(metabase):
+    async def main():
+        owner = asyncio.create_task(export(metabase['url'], ['1', '2']))
+        joined = asyncio.create_task(export(metabase['url'], ['1', '2']))
+        await asyncio.sleep(0.5)
+        owner.cancel()
+        return await joined
+
+    records = asyncio.run(main())
+
+    assert len(metabase['posts']) == 1
+    assert records == [{'ID': '1', 'Name': 'name 1'}, {'ID': '2', 'Name': 'name 2'}]
+
+
+def test_calls_in_different_event_loops_are_not_coalesced(metabase):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(asyncio.run(export(metabase['url'], ['1', '2'])))) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(metabase['posts']) == 2
+    assert results == [[{'ID': '1', 'Name': 'name 1'}, {'ID': '2', 'Name': 'name 2'}]] * 2
+
+
+def test_coalesce_request_survives_cancelled_waiter():
+    calls = []
+
+    async def get_data():
+        calls.append(1)
+        await asyncio.sleep(0.2)
+        return ['record']
+
+    async def main():
+        waiters = [asyncio.create_task(coalesce_request(key='key', get_data=get_data, verbose=False)) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        waiters[0].cancel()
+        return await asyncio.gather(*waiters, return_exceptions=True)
+
+    first, *others = asyncio.run(main())
+
+    assert isinstance(first, asyncio.CancelledError)
+    assert others == [['record']] * 2
+    assert len(calls) == 1
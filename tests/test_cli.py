@@ -0,0 +1,148 @@
+import asyncio
+import csv
+import json
+
+import pytest
+
+from metabase_query_api import SpillBuffer
+from metabase_query_api import cli
+from metabase_query_api.cli import load_manifest, main, write_output
+
+
+def write_manifest(tmp_path, manifest, name='manifest.json'):
+    path = tmp_path / name
+    path.write_text(manifest if isinstance(manifest, str) else json.dumps(manifest))
+    return str(path)
+
+
+@pytest.mark.parametrize('manifest, error', [
+    ({'session': 'x'}, 'jobs list'),
+    ('"jobs"', 'jobs list'),
+    ({'defaults': [1], 'jobs': []}, 'defaults must be a mapping'),
+    ({'jobs': ['job']}, 'Job 1 must be a mapping'),
+    ({'jobs': [{'output': 'a.json'}]}, 'Job 1 has no url'),
+    ({'jobs': [{'url': 'u'}]}, 'Job 1 has no output'),
+    ({'jobs': [{'url': 'u', 'output': 'a.txt', 'format': 'txt'}]}, 'accepted values for format'),
+    ({'jobs': [{'url': 'u', 'output': 'a.json', 'bulk_filter_slug': 'id'}]}, 'no values_file'),
+    ({'jobs': [{'url': 'u', 'output': 'a.xlsx', 'format': 'xlsx', 'bulk_filter_slug': 'id', 'values_file': 'ids.txt'}]}, 'json and csv'),
+])
+def test_load_manifest_errors(tmp_path, manifest, error):
+    with pytest.raises(ValueError, match=error):
+        load_manifest(write_manifest(tmp_path, manifest))
+
+
+def test_load_manifest_merges_defaults_and_resolves_paths(tmp_path):
+    path = write_manifest(tmp_path, {'session': 'x',
+                                     'defaults': {'retry_attempts': 5, 'format': 'csv'},
+                                     'jobs': [{'url': 'u', 'output': 'out/a.csv'},
+                                              {'name': 'bulk', 'url': 'u', 'output': 'b.json', 'format': 'json', 'bulk_filter_slug': 'id', 'values_file': 'ids.txt'}]})
+
+    manifest = load_manifest(path)
+
+    assert manifest['session'] == 'x'
+    assert manifest['jobs'] == [
+        {'url': 'u', 'output': str(tmp_path / 'out/a.csv'), 'name': 'a', 'format': 'csv', 'retry_attempts': 5},
+        {'url': 'u', 'output': str(tmp_path / 'b.json'), 'name': 'bulk', 'format': 'json', 'retry_attempts': 5, 'bulk_filter_slug': 'id', 'values_file': str(tmp_path / 'ids.txt')},
+    ]
+
+
+def test_load_manifest_empty_yaml_defaults(tmp_path):
+    pytest.importorskip('yaml')
+    path = write_manifest(tmp_path, 'defaults:\njobs:\n  - url: u\n    output: a.json\n', name='manifest.yaml')
+
+    assert load_manifest(path)['jobs'] == [{'url': 'u', 'output': str(tmp_path / 'a.json'), 'name': 'a', 'format': 'json'}]
+
+
+RECORDS = [{'ID': '1', 'Name': 'name 1'}, {'ID': '2', 'Extra': 'x'}]
+
+
+def spill_buffer():
+    async def main():
+        buffer = SpillBuffer(max_memory_rows=1)
+        await buffer.put(RECORDS)
+        return buffer
+
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize('make_data', [lambda: RECORDS, spill_buffer])
+def test_write_output_json(tmp_path, make_data):
+    path = tmp_path / 'out' / 'a.json'
+
+    rows, size = write_output(path=str(path), data=make_data(), data_format='json')
+
+    assert json.loads(path.read_text()) == RECORDS
+    assert (rows, size) == (2, path.stat().st_size)
+
+
+@pytest.mark.parametrize('make_data', [lambda: RECORDS, spill_buffer])
+def test_write_output_csv(tmp_path, make_data):
+    path = tmp_path / 'a.csv'
+
+    rows, size = write_output(path=str(path), data=make_data(), data_format='csv')
+
+    with open(path, newline='') as file:
+        reader = csv.DictReader(file)
+        assert reader.fieldnames == ['ID', 'Name', 'Extra']
+        assert list(reader) == [{'ID': '1', 'Name': 'name 1', 'Extra': ''}, {'ID': '2', 'Name': '', 'Extra': 'x'}]
+    assert (rows, size) == (2, path.stat().st_size)
+
+
+def test_write_output_bytes(tmp_path):
+    path = tmp_path / 'a.xlsx'
+
+    assert write_output(path=str(path), data=b'content', data_format='xlsx') == (None, 7)
+    assert path.read_bytes() == b'content'
+
+
+def test_main_returns_0_when_all_jobs_succeed(tmp_path, metabase):
+    (tmp_path / 'ids.txt').write_text('1\n2\n\n3\n')
+    path = write_manifest(tmp_path, {'session': 'x', 'jobs': [
+        {'url': metabase['url'], 'output': 'a.json'},
+        {'name': 'bulk', 'url': metabase['url'], 'output': 'b.csv', 'format': 'csv', 'bulk_filter_slug': 'id', 'values_file': 'ids.txt', 'max_memory_rows': 1},
+    ]})
+
+    assert main([path]) == 0
+    assert json.loads((tmp_path / 'a.json').read_text()) == [{'ID': '1', 'Name': 'name 1'}]
+    assert (tmp_path / 'b.csv').read_text().splitlines() == ['ID,Name', '1,name 1', '2,name 2', '3,name 3']
+
+
+def test_main_returns_1_when_a_job_fails(tmp_path, metabase, capsys):
+    path = write_manifest(tmp_path, {'session': 'x', 'jobs': [
+        {'name': 'ok', 'url': metabase['url'], 'output': 'a.json'},
+        {'name': 'bad', 'url': metabase['url'].replace('/1-example', '/2-example'), 'output': 'b.json'},
+    ]})
+
+    assert main([path]) == 1
+    assert (tmp_path / 'a.json').exists()
+    assert not (tmp_path / 'b.json').exists()
+    assert '1 succeeded, 1 failed' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('argv, manifest_session, env_session, expected', [
+    (['--session', 'flag'], 'manifest', 'env', 'flag'),
+    ([], 'manifest', 'env', 'manifest'),
+    ([], None, 'env', 'env'),
+])
+def test_main_session_precedence(tmp_path, monkeypatch, argv, manifest_session, env_session, expected):
+    sessions = []
+
+    async def run_jobs(jobs, session, **kwargs):
+        sessions.append(session)
+        return [], 0.0
+
+    monkeypatch.setattr(cli, 'run_jobs', run_jobs)
+    monkeypatch.setenv('METABASE_SESSION', env_session)
+    path = write_manifest(tmp_path, {'session': manifest_session, 'jobs': []})
+
+    assert main([path] + argv) == 0
+    assert sessions == [expected]
+
+
+def test_main_without_session_exits_with_usage_error(tmp_path, monkeypatch):
+    monkeypatch.delenv('METABASE_SESSION', raising=False)
+
+    with pytest.raises(SystemExit) as error:
+        main([write_manifest(tmp_path, {'jobs': []})])
+
+    assert error.value.code == 2
@@ -0,0 +1,95 @@
+import asyncio
+import gzip
+import os
+
+import pytest
+
+from metabase_query_api import SpillBuffer
+
+
+def records(*ids):
+    return [{'ID': i} for i in ids]
+
+
+def test_spills_once_over_budget():
+    async def main():
+        buffer = SpillBuffer(max_memory_rows=3)
+        await buffer.put(records(1, 2))
+        assert buffer.path is None
+
+        await buffer.put(records(3, 4))
+        assert os.path.exists(buffer.path)
+        assert buffer.spilled_rows == 4
+        assert buffer.lines == []
+        assert not buffer.over_budget()
+        return buffer
+
+    asyncio.run(main()).close()
+
+
+def test_spills_over_bytes_budget():
+    async def main():
+        buffer = SpillBuffer(max_memory_bytes=15)
+        await buffer.put(records(1))
+        assert buffer.path is None
+        await buffer.put(records(2))
+        assert buffer.spilled_rows == 2
+        return buffer
+
+    asyncio.run(main()).close()
+
+
+def test_iterates_spilled_then_memory_records():
+    async def main():
+        buffer = SpillBuffer(max_memory_rows=3)
+        await buffer.put(records(1, 2, 3, 4))
+        await buffer.put(records(5, 6))
+        return buffer
+
+    with asyncio.run(main()) as buffer:
+        assert len(buffer) == 6
+        assert buffer.spilled_rows == 4
+        assert list(buffer) == records(1, 2, 3, 4, 5, 6)
+        # Iterating again gives the same records
+        assert list(buffer) == records(1, 2, 3, 4, 5, 6)
+
+
+def test_put_after_iterating_appends_a_gzip_member():
+    async def main():
+        buffer = SpillBuffer(max_memory_rows=1)
+        await buffer.put(records(1, 2))
+        assert list(buffer) == records(1, 2)
+
+        await buffer.put(records(3, 4))
+        return buffer
+
+    with asyncio.run(main()) as buffer:
+        assert len(buffer) == 4
+        assert list(buffer) == records(1, 2, 3, 4)
+        with open(buffer.path, 'rb') as file:
+            assert file.read().count(b'\x1f\x8b\x08') == 2
+        with gzip.open(buffer.path, 'rb') as file:
+            assert len(file.readlines()) == 4
+
+
+def test_close_removes_file_and_resets_counters():
+    async def main():
+        buffer = SpillBuffer(max_memory_rows=2)
+        await buffer.put(records(1, 2, 3))
+        await buffer.put(records(4))
+        path = buffer.path
+
+        buffer.close()
+
+        assert not os.path.exists(path)
+        assert len(buffer) == 0
+        assert buffer.memory_rows == buffer.memory_bytes == 0
+        await asyncio.wait_for(buffer.wait_for_room(), timeout=1)
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize('budget', [{'max_memory_rows': 0}, {'max_memory_bytes': -1}])
+def test_rejects_non_positive_budget(budget):
+    with pytest.raises(ValueError):
+        SpillBuffer(**budget)